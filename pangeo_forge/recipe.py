@@ -2,22 +2,51 @@
 A Pangeo Forge Recipe
 """
 
+import asyncio
 import logging
+import threading
 from abc import ABC, abstractmethod
-from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
 from dataclasses import dataclass, field
 from typing import Callable, Hashable, Iterable, NoReturn, Optional
 
+import dask.array as dsa
 import fsspec
+import fsspec.asyn
 import xarray as xr
 import zarr
+from numcodecs import Blosc
 from rechunker.types import MultiStagePipeline, ParallelPipelines, Stage
 
-from .storage import AbstractTarget, UninitializedTarget
-from .utils import chunked_iterable, fix_scalar_attr_encoding
+from .storage import AbstractTarget, BufferedMapper, UninitializedTarget
+from .utils import (
+    concat_numpy,
+    copy_fileobj,
+    fix_scalar_attr_encoding,
+    run_pipelined,
+    zarr_array_encoding,
+)
 
 logger = logging.getLogger(__name__)
 
+# inputs are assumed to be aligned, so skip the expensive coordinate checks;
+# data variables are all concatenated, like in Xarray, so that variables without
+# the sequence dimension are stored too
+DEFAULT_CONCAT_KWARGS = dict(
+    data_vars="all",
+    coords="minimal",
+    compat="override",
+    join="exact",
+    combine_attrs="override",
+)
+
+# compressor for the data variables of the target, unless specified otherwise
+DEFAULT_COMPRESSOR = Blosc(cname="zstd", clevel=3, shuffle=Blosc.BITSHUFFLE)
+
+# block size used when streaming inputs into the cache
+COPY_BLOCK_SIZE = 16 * 1024 * 1024
+
 # How to manually execute a recipe: ###
 #
 #   t = PangeoForgeTarget()
@@ -43,6 +72,31 @@ logger = logging.getLogger(__name__)
 # 6)
 
 
+async def _iter_blocks(fs, path):
+    # download with range requests so that memory use stays bounded
+    size = (await fs._info(path)).get("size")
+    if not size or size <= COPY_BLOCK_SIZE:
+        yield await fs._cat_file(path)
+        return
+    for start in range(0, size, COPY_BLOCK_SIZE):
+        data = await fs._cat_file(path, start=start, end=min(start + COPY_BLOCK_SIZE, size))
+        yield data
+        if start == 0 and len(data) == size:
+            # the server ignored the range request
+            return
+
+
+def _is_async_input(fname):
+    fs, _ = fsspec.core.url_to_fs(str(fname))
+    return fs.async_impl
+
+
+def _select_variables(ds, variables):
+    if variables is None:
+        return ds
+    return ds[[v for v in variables if v in ds.variables]]
+
+
 @contextmanager
 def input_opener(fname, **kwargs):
     logger.info(f"Opening input '{fname}'")
@@ -101,14 +155,20 @@ class BaseRecipe(ABC):
         """
 
         pipeline = []  # type: MultiStagePipeline
-        pipeline.append(Stage(self.cache_input, list(self.iter_inputs())))
+        pipeline.append(self._cache_stage())
         pipeline.append(Stage(self.prepare_target))
-        pipeline.append(Stage(self.store_chunk, list(self.iter_chunks())))
+        pipeline.append(self._store_stage())
         pipeline.append(Stage(self.finalize_target))
         pipelines = []  # type: ParallelPipelines
         pipelines.append(pipeline)
         return pipelines
 
+    def _cache_stage(self) -> Stage:
+        return Stage(self.cache_input, list(self.iter_inputs()))
+
+    def _store_stage(self) -> Stage:
+        return Stage(self.store_chunk, list(self.iter_chunks()))
+
 
 # Notes about dataclasses:
 # - https://www.python.org/dev/peps/pep-0557/#inheritance
@@ -137,10 +197,31 @@ class NetCDFtoZarrSequentialRecipe(BaseRecipe):
       live on a slow network.
     :param consolidate_zarr: Whether to consolidate the resulting Zarr dataset.
     :param xarray_open_kwargs: Extra options for opening the inputs with Xarray.
-    :param xarray_concat_kwargs: Extra options to pass to Xarray when concatenating
-      the inputs to form a chunk.
+    :param xarray_concat_kwargs: Options to pass to Xarray when concatenating
+      the inputs to form a chunk. The defaults skip checking that coordinates and
+      non-concatenated variables are equal across inputs; passing any other options
+      replaces them, e.g. ``{}`` restores Xarray's own (strict) defaults.
     :param delete_input_encoding: Whether to remove Xarray encoding from variables
       in the input dataset
+    :param target_encoding: Zarr encoding of the variables in the target, as a
+      dictionary mapping variable names to encoding options, e.g.
+      ``{"foo": {"compressor": None}}``. By default, data variables are compressed
+      with Blosc-Zstd and bit shuffling.
+    :param lazy_open_input: Whether to open the inputs of a chunk lazily and load
+      them into memory only after they are concatenated. Otherwise each input is
+      loaded as soon as it is opened.
+    :param template_ds: A dataset with the structure of the first chunk, used
+      to initialize the target. If not provided, it is built from the metadata
+      of the inputs of the first chunk.
+    :param max_workers: The number of inputs cached concurrently.
+      When greater than 1, the pipeline caches all inputs in a single stage
+      using a thread pool instead of one task per input.
+    :param max_downloads: The number of inputs on an asynchronous filesystem
+      (e.g. http) downloaded concurrently. If any input is on such a filesystem,
+      the pipeline caches all inputs in a single stage from one event loop.
+    :param store_workers: The number of threads used to store chunks concurrently.
+      When greater than 1, the pipeline stores all chunks in a single stage
+      using a thread pool instead of one task per chunk.
     """
 
     input_urls: Iterable[str] = field(repr=False)
@@ -152,27 +233,49 @@ class NetCDFtoZarrSequentialRecipe(BaseRecipe):
     require_cache: bool = True
     consolidate_zarr: bool = True
     xarray_open_kwargs: dict = field(default_factory=dict)
-    xarray_concat_kwargs: dict = field(default_factory=dict)
+    xarray_concat_kwargs: dict = field(default_factory=lambda: dict(DEFAULT_CONCAT_KWARGS))
     delete_input_encoding: bool = True
+    target_encoding: Optional[dict] = None
+    lazy_open_input: bool = True
+    template_ds: Optional[xr.Dataset] = field(default=None, repr=False)
+    max_workers: int = 1
+    max_downloads: int = 16
+    store_workers: int = 1
 
     def __post_init__(self):
-        self._chunks_inputs = {
-            k: v for k, v in enumerate(chunked_iterable(self.input_urls, self.inputs_per_chunk))
-        }
+        # chunk k holds the inputs k * inputs_per_chunk to (k + 1) * inputs_per_chunk,
+        # so there is no need to store the inputs of each chunk
+        self._input_urls = list(self.input_urls)
+        ninputs = len(self._input_urls)
+        nchunks = -(-ninputs // self.inputs_per_chunk)
+        self._all_chunk_keys = range(nchunks)
+        # an input used by several chunks only needs to be cached once
+        self._all_input_keys = list(dict.fromkeys(self._input_urls))
+
+        # these never change, so compute them once instead of for every chunk
+        self._nitems_for_chunk = [self.nitems_per_input * self.inputs_per_chunk] * nchunks
+        if nchunks:
+            # the last chunk may have fewer inputs
+            last_ninputs = ninputs - (nchunks - 1) * self.inputs_per_chunk
+            self._nitems_for_chunk[-1] = self.nitems_per_input * last_ninputs
+        stride = self.nitems_per_input * self.inputs_per_chunk
+        self._region_for_chunk = [
+            {self.sequence_dim: slice(k * stride, k * stride + nitems)}
+            for k, nitems in enumerate(self._nitems_for_chunk)
+        ]
+        self._reset_target_cache()
 
     @property
     def prepare_target(self) -> Callable:
         def _prepare_target():
 
-            try:
-                ds = self.open_target()
+            # a single key lookup, rather than trying to open the whole dataset
+            if ".zgroup" in self._get_mapper():
                 logger.info("Found an existing dataset in target")
-                logger.debug(f"{ds}")
-            except (FileNotFoundError, IOError, zarr.errors.GroupNotFoundError):
-                first_chunk_key = next(self.iter_chunks())
-                # for input_url in self.inputs_for_chunk(first_chunk_key):
-                #    self.cache_input(input_url)
-                ds = self.open_chunk(first_chunk_key).chunk()
+            else:
+                ds = self.open_template()
+                # each call to store_chunk writes exactly one Zarr chunk per variable
+                ds = ds.chunk({**{dim: -1 for dim in ds.dims}, **self.sequence_chunks()})
 
                 # make sure the concat dim has a valid fill_value to avoid
                 # overruns when writing chunk
@@ -190,34 +293,93 @@ class NetCDFtoZarrSequentialRecipe(BaseRecipe):
             logger.info(f"Caching input '{fname}'")
             with input_opener(fname, mode="rb") as source:
                 with self.input_cache.open(fname, mode="wb") as target:
-                    target.write(source.read())
+                    copy_fileobj(source, target, length=COPY_BLOCK_SIZE)
 
         return cache_func
 
+    @property
+    def cache_inputs_bulk(self) -> Callable:
+        def _cache_inputs_bulk(input_keys: Iterable[str]) -> None:
+            # caching is pure I/O, so threads overlap the per-request latency
+            cache_func = self.cache_input
+            with ThreadPoolExecutor(max_workers=self.max_workers) as ex:
+                list(ex.map(cache_func, input_keys))
+
+        return _cache_inputs_bulk
+
+    @property
+    def cache_inputs_async(self) -> Callable:
+        def _cache_inputs_async(input_keys: Iterable[str]) -> None:
+            # inputs on asynchronous filesystems (e.g. http) are all downloaded
+            # from a single event loop, the others go through the thread pool
+            by_fs = {}
+            sync_keys = []
+            for fname in input_keys:
+                fs, path = fsspec.core.url_to_fs(str(fname))
+                if fs.async_impl:
+                    by_fs.setdefault(fs, []).append((fname, path))
+                else:
+                    sync_keys.append(fname)
+
+            for fs, items in by_fs.items():
+                fsspec.asyn.sync(fs.loop, self._cache_inputs_async, fs, items)
+            if sync_keys:
+                self.cache_inputs_bulk(sync_keys)
+
+        return _cache_inputs_async
+
+    async def _cache_inputs_async(self, fs, items):
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(self.max_downloads)
+
+        async def _cache_one(fname, path):
+            async with semaphore:
+                logger.info(f"Caching input '{fname}'")
+                # writing to the cache may block, so keep it out of the event loop
+                try:
+                    with ExitStack() as stack:
+                        opener = self.input_cache.open(fname, mode="wb")
+                        target = await loop.run_in_executor(None, stack.enter_context, opener)
+                        async for data in _iter_blocks(fs, path):
+                            await loop.run_in_executor(None, target.write, data)
+                        await loop.run_in_executor(None, stack.pop_all().close)
+                except BaseException:
+                    # a truncated input would later be opened as if it was complete
+                    await loop.run_in_executor(None, self._discard_cached_input, fname)
+                    raise
+
+        await asyncio.gather(*[_cache_one(fname, path) for fname, path in items])
+
+    def _discard_cached_input(self, fname):
+        if self.input_cache.exists(fname):
+            self.input_cache.rm(fname)
+
     @property
     def store_chunk(self) -> Callable:
         def _store_chunk(chunk_key):
-            ds_chunk = self.open_chunk(chunk_key)
+            ds_chunk = self._open_chunk_for_store(chunk_key)
+            self._write_chunk(chunk_key, ds_chunk)
 
-            def drop_vars(ds):
-                # writing a region means that all the variables MUST have sequence_dim
-                to_drop = [v for v in ds.variables if self.sequence_dim not in ds[v].dims]
-                return ds.drop_vars(to_drop)
+        return _store_chunk
 
-            ds_chunk = drop_vars(ds_chunk)
-            target_mapper = self.target.get_mapper()
-            write_region = self.region_for_chunk(chunk_key)
-            logger.info(f"Storing chunk '{chunk_key}' to Zarr region {write_region}")
-            ds_chunk.to_zarr(target_mapper, region=write_region)
+    @property
+    def store_chunks_bulk(self) -> Callable:
+        def _store_chunks_bulk(chunk_keys: Iterable[int]) -> None:
+            # chunks are written to non-overlapping regions, and most of the work
+            # (decompression, encoding, I/O) releases the GIL
+            store_func = self.store_chunk
+            store_workers = self._writer_threads(self.store_workers)
+            with ThreadPoolExecutor(max_workers=store_workers) as ex:
+                list(ex.map(store_func, chunk_keys))
 
-        return _store_chunk
+        return _store_chunks_bulk
 
     @property
     def finalize_target(self) -> Callable:
         def _finalize_target():
             if self.consolidate_zarr:
                 logger.info("Consolidating Zarr metadata")
-                target_mapper = self.target.get_mapper()
+                target_mapper = self._get_mapper()
                 zarr.consolidate_metadata(target_mapper)
 
         return _finalize_target
@@ -241,82 +403,328 @@ class NetCDFtoZarrSequentialRecipe(BaseRecipe):
                 with input_opener(fname, mode="rb") as f:
                     yield f
 
-    def open_input(self, fname: str):
+    def open_input(self, fname: str, variables: Optional[Iterable[str]] = None):
         with self.input_opener(fname) as f:
             logger.info(f"Opening input with Xarray '{fname}'")
             ds = xr.open_dataset(f, **self.xarray_open_kwargs)
+            ds = _select_variables(ds, variables)
             # explicitly load into memory
             ds = ds.load()
-        ds = fix_scalar_attr_encoding(ds)
-
-        if self.delete_input_encoding:
-            for var in ds.variables:
-                ds[var].encoding = {}
-
+        ds = self._fix_input(ds)
         logger.debug(f"{ds}")
         return ds
 
-    def open_chunk(self, chunk_key):
+    @contextmanager
+    def _open_inputs_lazy(self, fnames, variables=None):
+        # the files must stay open for as long as data may be read from them
+        open_kwargs = {"chunks": {}, **self.xarray_open_kwargs}
+        with ExitStack() as stack:
+            dsets = []
+            for fname in fnames:
+                f = stack.enter_context(self.input_opener(fname))
+                logger.info(f"Opening input lazily with Xarray '{fname}'")
+                ds = xr.open_dataset(f, **open_kwargs)
+                ds = _select_variables(ds, variables)
+                dsets.append(self._fix_input(ds))
+            yield dsets
+
+    def _fix_input(self, ds):
+        return fix_scalar_attr_encoding(ds, clear_encoding=self.delete_input_encoding)
+
+    def open_chunk(self, chunk_key, variables: Optional[Iterable[str]] = None):
         logger.info(f"Concatenating inputs for chunk '{chunk_key}'")
         inputs = self.inputs_for_chunk(chunk_key)
-        dsets = [self.open_input(i) for i in inputs]
+        if self.lazy_open_input:
+            with self._open_inputs_lazy(inputs, variables) as dsets:
+                # concatenate first, then load into memory only once
+                ds = self._concat_inputs(dsets).load()
+        else:
+            dsets = [self.open_input(i, variables) for i in inputs]
+            ds = self._concat_inputs(dsets)
+        logger.debug(f"{ds}")
+
+        # TODO: maybe do some chunking here?
+        return ds
+
+    def _concat_inputs(self, dsets):
         # CONCAT DELETES ENCODING!!!
         # OR NO IT DOESN'T! Not in the latest version of xarray?
+        ds = None
+        if len(dsets) > 1 and self.xarray_concat_kwargs == DEFAULT_CONCAT_KWARGS:
+            # fast path, avoids xarray's per-variable alignment
+            ds = concat_numpy(dsets, self.sequence_dim)
+        if ds is None:
+            ds = xr.concat(dsets, self.sequence_dim, **self.xarray_concat_kwargs)
+        return ds
+
+    def _open_chunk_for_store(self, chunk_key):
+        # don't read the variables which are not written to the target
+        ds_chunk = self.open_chunk(chunk_key, variables=self._get_sequence_vars())
+
+        def drop_vars(ds):
+            # writing a region means that all the variables MUST have sequence_dim
+            to_drop = [v for v in ds.variables if self.sequence_dim not in ds[v].dims]
+            return ds.drop_vars(to_drop)
+
+        return drop_vars(ds_chunk)
+
+    def _write_chunk(self, chunk_key, ds_chunk):
+        write_region = self.region_for_chunk(chunk_key)
+        logger.info(f"Storing chunk '{chunk_key}' to Zarr region {write_region}")
+
+        if not ds_chunk.variables or self.sequence_dim not in ds_chunk.dims:
+            raise ValueError(
+                f"Chunk '{chunk_key}' has no variable along '{self.sequence_dim}' to store"
+            )
+
+        variables = ds_chunk.variables
+        if any(v.chunks is not None or v.dtype.kind not in "biufcmM" for v in variables.values()):
+            # let Xarray deal with dask arrays and strings
+            ds_chunk.to_zarr(self._get_mapper(), region=write_region)
+            return
+
+        # the arrays were already created by prepare_target, so we can write
+        # the encoded values straight into them
+        try:
+            for name, var in variables.items():
+                arr, encoding = self._get_zarray(name)
+                var = var.copy(deep=False)
+                var.encoding = encoding
+                var = xr.conventions.encode_cf_variable(var, name=name)
+                region = tuple(write_region.get(dim, slice(None)) for dim in var.dims)
+                arr[region] = var.values
+        except Exception:
+            # don't leave a partial chunk for the next write of this thread to flush
+            self._chunk_store.discard()
+            raise
+        # upload the Zarr chunks of all the variables at once
+        self._chunk_store.flush()
+
+    def _reset_target_cache(self):
+        self._target_mapper = None
+        self._mapper_target = None
+        self._reset_zgroup_cache()
+
+    def _reset_zgroup_cache(self):
+        self._zgroup = None
+        self._chunk_store = None
+        self._zarrays = {}
+        self._sequence_vars = None
+
+    def _get_mapper(self):
+        # the target may be reassigned after the recipe is created
+        if self._target_mapper is None or self._mapper_target is not self.target:
+            self._reset_target_cache()
+            self._target_mapper = self.target.get_mapper()
+            self._mapper_target = self.target
+        return self._target_mapper
+
+    def _get_zgroup(self):
+        target_mapper = self._get_mapper()
+        if self._zgroup is None:
+            self._zgroup = zarr.open_group(target_mapper, mode="r+")
+            self._chunk_store = BufferedMapper(self._zgroup.store)
+        return self._zgroup
+
+    def _get_zarray(self, name):
+        # returns the Zarr array for variable `name` along with its Xarray encoding
+        zgroup = self._get_zgroup()
+        if name not in self._zarrays:
+            # chunks are buffered and only written when _write_chunk flushes them
+            arr = zarr.Array(zgroup.store, path=name, chunk_store=self._chunk_store)
+            self._zarrays[name] = arr, zarr_array_encoding(name, arr)
+        return self._zarrays[name]
+
+    def _get_sequence_vars(self):
+        # the variables of the target which have sequence_dim
+        zgroup = self._get_zgroup()
+        if self._sequence_vars is None:
+            self._sequence_vars = [
+                name
+                for name, arr in zgroup.arrays()
+                if self.sequence_dim in arr.attrs["_ARRAY_DIMENSIONS"]
+            ]
+        return self._sequence_vars
+
+    def _target_chunks_aligned(self):
+        # concurrent writers must not share a Zarr chunk, which can happen if an
+        # existing target was created with a different number of inputs per chunk
+        nitems = self.sequence_chunks()[self.sequence_dim]
+        for name in self._get_sequence_vars():
+            arr, _ = self._get_zarray(name)
+            axis = arr.attrs["_ARRAY_DIMENSIONS"].index(self.sequence_dim)
+            if nitems % arr.chunks[axis]:
+                return False
+        return True
+
+    def _writer_threads(self, nthreads):
+        # open the target once, before the threads share it
+        self._get_zgroup()
+        if nthreads > 1 and not self._target_chunks_aligned():
+            logger.warning("Target chunks are not aligned with the recipe, storing serially")
+            return 1
+        return nthreads
+
+    def open_template(self):
+        """Return a dataset with the same structure as the first chunk, used to
+        initialize the target. Only the metadata, indexes, scalars and time
+        variables of the inputs are read.
+        """
+        if self.template_ds is not None:
+            return self.template_ds.copy()
+
+        first_chunk_key = next(self.iter_chunks())
+        logger.info(f"Building target template from chunk '{first_chunk_key}'")
+        with self._open_inputs_lazy(self.inputs_for_chunk(first_chunk_key)) as dsets:
+            dsets = [ds.copy() for ds in dsets]
+            # indexes are already in memory; replace everything else so that
+            # nothing refers to the open files any more
+            for ds in dsets:
+                for name, var in ds.variables.items():
+                    if name in ds.indexes:
+                        continue
+                    if var.ndim == 0 or var.dtype.kind in "mM":
+                        # Xarray picks the CF units of times from their values,
+                        # and scalars can't be written lazily; both are small
+                        var.load()
+                    else:
+                        var.data = dsa.zeros_like(var.data)
         ds = xr.concat(dsets, self.sequence_dim, **self.xarray_concat_kwargs)
         logger.debug(f"{ds}")
-
-        # TODO: maybe do some chunking here?
         return ds
 
     def open_target(self):
-        target_mapper = self.target.get_mapper()
+        target_mapper = self._get_mapper()
         return xr.open_zarr(target_mapper)
 
     def initialize_target(self, ds, **expand_dims):
         logger.info("Creating a new dataset in target")
-        target_mapper = self.target.get_mapper()
+        ds = ds.copy()
+        for name in ds.data_vars:
+            ds[name].encoding.setdefault("compressor", DEFAULT_COMPRESSOR)
+        for name, encoding in (self.target_encoding or {}).items():
+            ds[name].encoding.update(encoding)
+        target_mapper = self._get_mapper()
         ds.to_zarr(target_mapper, mode="w", compute=False)
+        # the group and its arrays were just overwritten
+        self._reset_zgroup_cache()
 
     def expand_target_dim(self, dim, dimsize):
-        target_mapper = self.target.get_mapper()
-        zgroup = zarr.open_group(target_mapper)
-
-        ds = self.open_target()
-        sequence_axes = {v: ds[v].get_axis_num(dim) for v in ds.variables if dim in ds[v].dims}
-
-        for v, axis in sequence_axes.items():
-            arr = zgroup[v]
+        # the dimension names are in the Zarr attributes, no need to open with Xarray
+        for name in self._get_zgroup().array_keys():
+            # resize through the cached handle so it sees the new shape
+            arr, _ = self._get_zarray(name)
+            dims = arr.attrs["_ARRAY_DIMENSIONS"]
+            if dim not in dims:
+                continue
             shape = list(arr.shape)
-            shape[axis] = dimsize
+            shape[dims.index(dim)] = dimsize
             arr.resize(shape)
 
     def inputs_for_chunk(self, chunk_key):
-        return self._chunks_inputs[chunk_key]
+        if chunk_key not in self._all_chunk_keys:
+            raise KeyError(chunk_key)
+        start = chunk_key * self.inputs_per_chunk
+        stop = start + self.inputs_per_chunk
+        return tuple(self._input_urls[start:stop])
 
     def iter_inputs(self):
-        for chunk_key in self.iter_chunks():
-            for input in self.inputs_for_chunk(chunk_key):
-                yield input
+        return iter(self._all_input_keys)
 
     def nitems_for_chunk(self, chunk_key):
-        return self.nitems_per_input * len(self.inputs_for_chunk(chunk_key))
+        return self._nitems_for_chunk[chunk_key]
 
     def region_for_chunk(self, chunk_key):
         # return a dict suitable to pass to xr.to_zarr(region=...)
         # specifies where in the overall array to put this chunk's data
-        stride = self.nitems_per_input * self.inputs_per_chunk
-        start = chunk_key * stride
-        region_slice = slice(start, start + self.nitems_for_chunk(chunk_key))
-        return {self.sequence_dim: region_slice}
+        return self._region_for_chunk[chunk_key]
 
     def sequence_len(self):
         # tells the total size of dataset along the sequence dimension
-        return sum([self.nitems_for_chunk(k) for k in self.iter_chunks()])
+        return sum(self._nitems_for_chunk)
 
     def sequence_chunks(self):
         # chunking
         return {self.sequence_dim: self.inputs_per_chunk * self.nitems_per_input}
 
     def iter_chunks(self):
-        for k in self._chunks_inputs:
-            yield k
+        return iter(self._all_chunk_keys)
+
+    def _cache_stage(self) -> Stage:
+        input_keys = list(self.iter_inputs())
+        if any(_is_async_input(fname) for fname in input_keys):
+            # a single task downloading all the inputs from one event loop
+            return Stage(self.cache_inputs_async, [input_keys])
+        if self.max_workers > 1:
+            # a single task caching all the inputs concurrently
+            return Stage(self.cache_inputs_bulk, [input_keys])
+        return super()._cache_stage()
+
+    def _store_stage(self) -> Stage:
+        if self.store_workers > 1:
+            # a single task storing all the chunks concurrently
+            return Stage(self.store_chunks_bulk, [list(self.iter_chunks())])
+        return super()._store_stage()
+
+    def to_pipelined_stages(
+        self,
+        downloader_workers: int = 4,
+        decoder_workers: int = 2,
+        writer_workers: int = 2,
+        queue_size: int = 2,
+    ) -> ParallelPipelines:
+        """Translate recipe to a pipeline in which caching, decoding and writing overlap.
+
+        After the target is prepared, every chunk goes through three pools of
+        threads: one caching its inputs, one opening it with Xarray and one
+        writing it to the target. The pools are connected by queues holding at
+        most ``queue_size`` chunks, so a fast stage can't run too far ahead.
+        All of this happens in a single stage, so it only makes sense with
+        executors that run in a single process, like ``PythonPipelineExecutor``.
+        Use ``to_pipelines`` for distributed executors.
+
+        :param downloader_workers: The number of threads caching inputs.
+        :param decoder_workers: The number of threads opening chunks.
+        :param writer_workers: The number of threads writing chunks to the target.
+        :param queue_size: The maximum number of chunks waiting between two stages.
+        """
+
+        # every input is cached once, even if it is used by several chunks, and
+        # the chunks sharing it wait until it is complete; the inputs of the first
+        # chunk are cached before the target is prepared
+        first_chunk_key = next(self.iter_chunks())
+        locks = {fname: threading.Lock() for fname in self.iter_inputs()}
+        first_inputs = list(dict.fromkeys(self.inputs_for_chunk(first_chunk_key)))
+        cached = set(first_inputs)
+
+        def cache_chunk(chunk_key):
+            for fname in self.inputs_for_chunk(chunk_key):
+                with locks[fname]:
+                    if fname not in cached:
+                        self.cache_input(fname)
+                        cached.add(fname)
+            return chunk_key
+
+        def open_chunk(chunk_key):
+            return chunk_key, self._open_chunk_for_store(chunk_key)
+
+        def write_chunk(item):
+            self._write_chunk(*item)
+
+        def _store_chunks_pipelined():
+            stages = [
+                (cache_chunk, downloader_workers),
+                (open_chunk, decoder_workers),
+                (write_chunk, self._writer_threads(writer_workers)),
+            ]
+            run_pipelined(self.iter_chunks(), stages, queue_size)
+
+        # the first chunk is needed to prepare the target
+        pipeline = []  # type: MultiStagePipeline
+        pipeline.append(Stage(self.cache_input, first_inputs))
+        pipeline.append(Stage(self.prepare_target))
+        pipeline.append(Stage(_store_chunks_pipelined))
+        pipeline.append(Stage(self.finalize_target))
+        pipelines = []  # type: ParallelPipelines
+        pipelines.append(pipeline)
+        return pipelines
@@ -1,13 +1,21 @@
 import os
 import re
+import threading
 import unicodedata
 from abc import ABC, abstractmethod
+from collections.abc import MutableMapping
 from contextlib import contextmanager
 from dataclasses import dataclass
 from typing import BinaryIO, NoReturn
 
 import fsspec
 
+try:
+    # zarr >= 2.11 wraps any other mapping, hiding its setitems method
+    from zarr.storage import BaseStore as _MappingBase
+except ImportError:
+    _MappingBase = MutableMapping
+
 
 class AbstractTarget(ABC):
     @abstractmethod
@@ -101,6 +109,77 @@ def _slugify(value):
     return re.sub(r"[-\s]+", "-", value).strip("-_")
 
 
+class BufferedMapper(_MappingBase):
+    """A mutable mapping that holds the items written by each thread in memory
+    until that thread calls ``flush``, which writes them to ``mapper`` in one batch.
+
+    With an asynchronous fsspec filesystem, the batch is uploaded concurrently.
+
+    :param mapper: The mapping to write through to, e.g. an ``fsspec.FSMap``.
+    """
+
+    def __init__(self, mapper):
+        self.mapper = mapper
+        self._local = threading.local()
+
+    @property
+    def _buffer(self) -> dict:
+        if not hasattr(self._local, "buffer"):
+            self._local.buffer = {}
+        return self._local.buffer
+
+    def __getitem__(self, key):
+        try:
+            return self._buffer[key]
+        except KeyError:
+            return self.mapper[key]
+
+    def __setitem__(self, key, value):
+        self._buffer[key] = value
+
+    def setitems(self, values):
+        self._buffer.update(values)
+
+    def __delitem__(self, key):
+        if self._buffer.pop(key, None) is None:
+            del self.mapper[key]
+        else:
+            self.mapper.pop(key, None)
+
+    def __contains__(self, key):
+        return key in self._buffer or key in self.mapper
+
+    def __iter__(self):
+        yield from self._buffer
+        for key in self.mapper:
+            if key not in self._buffer:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def flush(self) -> NoReturn:
+        """Write the items buffered by the current thread to the underlying mapper."""
+        buffer, self._local.buffer = self._buffer, {}
+        if not buffer:
+            return
+        if hasattr(self.mapper, "setitems"):
+            self.mapper.setitems(buffer)
+        else:
+            self.mapper.update(buffer)
+
+    def discard(self) -> NoReturn:
+        """Drop the items buffered by the current thread without writing them."""
+        self._local.buffer = {}
+
+    def __getstate__(self):
+        # thread-local buffers can't be pickled, and shouldn't be
+        return {"mapper": self.mapper}
+
+    def __setstate__(self, state):
+        self.__init__(state["mapper"])
+
+
 class UninitializedTarget(AbstractTarget):
     def get_mapper(self):
         raise UninitializedTargetError
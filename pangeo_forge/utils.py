@@ -1,6 +1,14 @@
+import errno
+import io
 import itertools
+import os
+import queue
+import shutil
+import stat
+import threading
 
 import numpy as np
+import xarray as xr
 
 
 # https://alexwlchan.net/2018/12/iterating-in-fixed-size-chunks/
@@ -13,9 +21,67 @@ def chunked_iterable(iterable, size):
         yield chunk
 
 
+_DONE = object()
+
+
+def run_pipelined(items, stages, queue_size=1):
+    """Pass ``items`` through a sequence of ``(func, nworkers)`` stages.
+
+    Each stage has its own pool of ``nworkers`` threads, and the result of
+    ``func`` is passed on to the next stage. Stages are connected by queues
+    holding at most ``queue_size`` items, so that work in different stages
+    overlaps while a slow stage applies backpressure to the previous ones.
+    The first exception raised by any stage is re-raised once all the threads
+    have stopped.
+    """
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+    errors = []
+
+    def worker(func, q_in, q_out):
+        while True:
+            item = q_in.get()
+            if item is _DONE:
+                return
+            if errors:
+                # keep draining the queue so upstream threads don't block
+                continue
+            try:
+                result = func(item)
+            except Exception as e:
+                errors.append(e)
+                continue
+            if q_out is not None:
+                q_out.put(result)
+
+    pools = []
+    for n, (func, nworkers) in enumerate(stages):
+        q_out = queues[n + 1] if n + 1 < len(stages) else None
+        threads = [
+            threading.Thread(target=worker, args=(func, queues[n], q_out), daemon=True)
+            for _ in range(nworkers)
+        ]
+        for t in threads:
+            t.start()
+        pools.append(threads)
+
+    for item in items:
+        if errors:
+            break
+        queues[0].put(item)
+    # shut down the stages in order, once the previous one has flushed its results
+    for q, threads in zip(queues, pools):
+        for _ in threads:
+            q.put(_DONE)
+        for t in threads:
+            t.join()
+
+    if errors:
+        raise errors[0]
+
+
 # only needed because of
 # https://github.com/pydata/xarray/issues/4631
-def fix_scalar_attr_encoding(ds):
+def fix_scalar_attr_encoding(ds, clear_encoding=False):
     def _fixed_attrs(d):
         fixed = {}
         for k, v in d.items():
@@ -26,7 +92,144 @@ def fix_scalar_attr_encoding(ds):
     ds = ds.copy()
     ds.attrs.update(_fixed_attrs(ds.attrs))
     ds.encoding.update(_fixed_attrs(ds.encoding))
-    for v in ds.variables:
-        ds[v].attrs.update(_fixed_attrs(ds[v].attrs))
-        ds[v].encoding.update(_fixed_attrs(ds[v].encoding))
+    # work on the variables directly, creating a DataArray for each one is slow
+    for var in ds.variables.values():
+        var.attrs.update(_fixed_attrs(var.attrs))
+        if clear_encoding:
+            var.encoding = {}
+        else:
+            var.encoding.update(_fixed_attrs(var.encoding))
     return ds
+
+
+def _can_concat_numpy(dsets, dim):
+    # without the dimension, xr.concat would create it, np.concatenate can't
+    if any(dim not in ds.dims for ds in dsets):
+        return False
+    first = dsets[0]
+    for ds in dsets[1:]:
+        if set(ds.variables) != set(first.variables):
+            return False
+        for name, var in first.variables.items():
+            other = ds.variables[name]
+            if other.dims != var.dims:
+                return False
+            if dim not in var.dims and name not in first.data_vars:
+                continue
+            for d, size, other_size in zip(var.dims, var.shape, other.shape):
+                if d != dim and size != other_size:
+                    return False
+        for name, index in first.indexes.items():
+            if name != dim and not index.equals(ds.indexes[name]):
+                return False
+    return True
+
+
+def concat_numpy(dsets, dim):
+    """Concatenate datasets along ``dim`` with ``np.concatenate``.
+
+    This is equivalent to ``xr.concat`` with ``data_vars="all"``,
+    ``coords="minimal"``, ``compat="override"`` and ``combine_attrs="override"``,
+    but skips xarray's alignment machinery. Returns ``None`` if the datasets do
+    not share the same variables and non-concatenated shapes.
+    """
+    if not _can_concat_numpy(dsets, dim):
+        return None
+
+    first = dsets[0]
+    variables = {}
+    for name, var in first.variables.items():
+        if dim in var.dims:
+            data = np.concatenate(
+                [ds.variables[name].values for ds in dsets], axis=var.get_axis_num(dim)
+            )
+            var = xr.Variable(var.dims, data, var.attrs, var.encoding)
+        elif name in first.data_vars:
+            # like xr.concat, repeat the data variable along the new dimension
+            data = np.concatenate(
+                [
+                    np.broadcast_to(ds.variables[name].values, (ds.dims[dim],) + var.shape)
+                    for ds in dsets
+                ]
+            )
+            var = xr.Variable((dim,) + var.dims, data, var.attrs, var.encoding)
+        variables[name] = var
+    ds = xr.Dataset(variables, attrs=first.attrs)
+    ds = ds.set_coords([name for name in first.coords if name not in ds.coords])
+    ds.encoding = dict(first.encoding)
+    return ds
+
+
+def zarr_array_encoding(name, arr):
+    """Return the Xarray encoding of the variable ``name`` stored in Zarr array ``arr``.
+
+    This is the encoding ``xr.open_zarr`` would give the variable, without
+    having to open the whole group with Xarray.
+    """
+    attrs = dict(arr.attrs)
+    dims = attrs.pop("_ARRAY_DIMENSIONS")
+    if arr.fill_value is not None:
+        attrs["_FillValue"] = arr.fill_value
+    # decoding only looks at the attributes, so there is no need to read any data
+    var = xr.Variable(dims, np.empty((0,) * len(dims), dtype=arr.dtype), attrs)
+    return xr.conventions.decode_cf_variable(name, var).encoding
+
+
+def _regular_fileno(f):
+    try:
+        fd = f.fileno()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return None
+    if not stat.S_ISREG(os.fstat(fd).st_mode):
+        return None
+    return fd
+
+
+def _copy_file_range(source, target):
+    # copy in the kernel without going through a user-space buffer
+    # returns False if the zero-copy path is not available
+    if not hasattr(os, "copy_file_range"):
+        return False
+    src_fd = _regular_fileno(source)
+    dst_fd = _regular_fileno(target)
+    if src_fd is None or dst_fd is None:
+        return False
+    # the file descriptors must be positioned where the file objects think they are
+    source.seek(source.tell())
+    target.flush()
+    copied = 0
+    while True:
+        try:
+            n = os.copy_file_range(src_fd, dst_fd, 1 << 30)
+        except OSError as e:
+            unsupported = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP)
+            if copied == 0 and e.errno in unsupported:
+                return False
+            raise
+        if n == 0:
+            return True
+        copied += n
+
+
+def _copy_readinto(source, target, length):
+    # reuse a single buffer instead of allocating a new bytes object per block
+    buf = memoryview(bytearray(length))
+    while True:
+        n = source.readinto(buf)
+        if not n:
+            return
+        target.write(buf[:n])
+
+
+def copy_fileobj(source, target, length=16 * 1024 * 1024):
+    """Copy the contents of file-like object ``source`` to ``target``.
+
+    Uses ``os.copy_file_range`` when both objects are backed by regular local
+    files and falls back to a buffered copy otherwise.
+    """
+    if _copy_file_range(source, target):
+        return
+    if hasattr(source, "readinto"):
+        _copy_readinto(source, target, length)
+    else:
+        shutil.copyfileobj(source, target, length)
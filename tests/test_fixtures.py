@@ -2,7 +2,7 @@ import fsspec
 import pytest
 import xarray as xr
 
-from pangeo_forge.storage import UninitializedTargetError
+from pangeo_forge.storage import BufferedMapper, UninitializedTargetError
 from pangeo_forge.utils import fix_scalar_attr_encoding
 
 
@@ -58,3 +58,23 @@ def test_cache(tmp_cache):
         assert f.read() == "bar"
     tmp_cache.rm("foo")
     assert not tmp_cache.exists("foo")
+
+
+def test_buffered_mapper(tmp_target):
+    mapper = tmp_target.get_mapper()
+    buffered = BufferedMapper(mapper)
+    buffered["foo"] = b"bar"
+    buffered.setitems({"baz": b"qux"})
+    assert buffered["foo"] == b"bar"
+    assert "foo" in buffered
+    assert "foo" not in mapper
+    buffered.flush()
+    assert mapper["foo"] == b"bar"
+    assert mapper["baz"] == b"qux"
+    del buffered["foo"]
+    assert "foo" not in mapper
+    buffered["foo"] = b"bar"
+    buffered.discard()
+    assert "foo" not in buffered
+    buffered.flush()
+    assert "foo" not in mapper
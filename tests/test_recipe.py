@@ -1,12 +1,38 @@
+import asyncio
+import dataclasses
+
+import numpy as np
 import pytest
 import xarray as xr
+import zarr
 
 from pangeo_forge import recipe
-from pangeo_forge.storage import UninitializedTargetError
+from pangeo_forge.executors import PythonPipelineExecutor
+from pangeo_forge.storage import FSSpecTarget, UninitializedTargetError
 
 dummy_fnames = ["a.nc", "b.nc", "c.nc"]
 
 
+def execute_recipe(r):
+    # this is the cannonical way to manually execute a recipe
+    for input_key in r.iter_inputs():
+        r.cache_input(input_key)
+    r.prepare_target()
+    for chunk_key in r.iter_chunks():
+        r.store_chunk(chunk_key)
+    r.finalize_target()
+
+
+def execute_pipelines(pipelines):
+    ex = PythonPipelineExecutor()
+    ex.execute_plan(ex.pipelines_to_plan(pipelines))
+
+
+def assert_target_identical(r, ds_expected):
+    ds_target = xr.open_zarr(r.target.get_mapper(), consolidated=True).load()
+    assert ds_target.identical(ds_expected)
+
+
 @pytest.mark.skip(reason="Removed this class for now")
 @pytest.mark.parametrize(
     "file_urls, files_per_chunk, expected_keys, expected_filenames",
@@ -35,8 +61,48 @@ def test_sequence_recipe(file_urls, files_per_chunk, expected_keys, expected_fil
         assert fnames == expected
 
 
+@pytest.mark.parametrize(
+    "file_urls, files_per_chunk, expected_keys, expected_filenames",
+    [
+        (dummy_fnames, 1, [0, 1, 2], [("a.nc",), ("b.nc",), ("c.nc",)]),
+        (dummy_fnames, 2, [0, 1], [("a.nc", "b.nc",), ("c.nc",),],),  # noqa: E231
+    ],
+)
+def test_NetCDFtoZarrSequentialRecipe_chunks(
+    file_urls, files_per_chunk, expected_keys, expected_filenames
+):
+    r = recipe.NetCDFtoZarrSequentialRecipe(
+        input_urls=file_urls, sequence_dim="time", inputs_per_chunk=files_per_chunk,
+    )
+
+    assert r.sequence_len() == len(file_urls)
+    assert list(r.iter_chunks()) == expected_keys
+    assert list(r.iter_inputs()) == file_urls
+    for k, expected in zip(r.iter_chunks(), expected_filenames):
+        assert r.inputs_for_chunk(k) == expected
+    last_key = expected_keys[-1]
+    assert r.region_for_chunk(last_key) == {"time": slice(last_key * files_per_chunk, 3)}
+    with pytest.raises(KeyError):
+        r.inputs_for_chunk(len(expected_keys))
+
+
+def test_NetCDFtoZarrSequentialRecipe_duplicate_inputs():
+    r = recipe.NetCDFtoZarrSequentialRecipe(
+        input_urls=["a.nc", "b.nc", "a.nc"], sequence_dim="time", inputs_per_chunk=2
+    )
+    assert r.inputs_for_chunk(1) == ("a.nc",)
+    assert list(r.iter_inputs()) == ["a.nc", "b.nc"]
+
+
+@pytest.mark.parametrize("lazy_open_input", [True, False])
+@pytest.mark.parametrize("inputs_per_chunk", [1, 2])
 def test_NetCDFtoZarrSequentialRecipe(
-    daily_xarray_dataset, netcdf_local_paths, tmp_target, tmp_cache
+    daily_xarray_dataset,
+    netcdf_local_paths,
+    tmp_target,
+    tmp_cache,
+    inputs_per_chunk,
+    lazy_open_input,
 ):
 
     # the same recipe is created as a fixture in conftest.py
@@ -44,23 +110,15 @@ def test_NetCDFtoZarrSequentialRecipe(
     r = recipe.NetCDFtoZarrSequentialRecipe(
         input_urls=netcdf_local_paths,
         sequence_dim="time",
-        inputs_per_chunk=1,
+        inputs_per_chunk=inputs_per_chunk,
         nitems_per_input=daily_xarray_dataset.attrs["items_per_file"],
         target=tmp_target,
         input_cache=tmp_cache,
+        lazy_open_input=lazy_open_input,
     )
 
-    # this is the cannonical way to manually execute a recipe
-    for input_key in r.iter_inputs():
-        r.cache_input(input_key)
-    r.prepare_target()
-    for chunk_key in r.iter_chunks():
-        r.store_chunk(chunk_key)
-    r.finalize_target()
-
-    ds_target = xr.open_zarr(tmp_target.get_mapper(), consolidated=True).load()
-    ds_expected = daily_xarray_dataset.compute()
-    assert ds_target.identical(ds_expected)
+    execute_recipe(r)
+    assert_target_identical(r, daily_xarray_dataset.compute())
 
 
 def test_NetCDFtoZarrSequentialRecipeNoTarget(
@@ -77,3 +135,335 @@ def test_NetCDFtoZarrSequentialRecipeNoTarget(
     # this is the cannonical way to manually execute a recipe
     with pytest.raises(UninitializedTargetError):
         r.cache_input(next(r.iter_inputs()))
+
+
+def test_NetCDFtoZarrSequentialRecipe_bulk(netCDFtoZarr_sequential_recipe):
+    r, ds_expected, _ = netCDFtoZarr_sequential_recipe
+    r.max_workers = 4
+    r.store_workers = 4
+
+    r.cache_inputs_bulk(list(r.iter_inputs()))
+    for input_key in r.iter_inputs():
+        assert r.input_cache.exists(input_key)
+
+    execute_pipelines(r.to_pipelines())
+    assert_target_identical(r, ds_expected)
+
+
+def test_NetCDFtoZarrSequentialRecipe_pipelined_stages(netCDFtoZarr_sequential_recipe):
+    r, ds_expected, _ = netCDFtoZarr_sequential_recipe
+    execute_pipelines(r.to_pipelined_stages(queue_size=1))
+    assert_target_identical(r, ds_expected)
+
+
+def test_NetCDFtoZarrSequentialRecipe_pipelined_stages_shared_inputs(
+    netCDFtoZarr_sequential_recipe, monkeypatch
+):
+    r, _, _ = netCDFtoZarr_sequential_recipe
+    # every input but the first one is used by two chunks
+    fnames = list(r.iter_inputs())
+    input_urls = [fnames[0]] + [fname for fname in fnames[1:] for _ in range(2)]
+    r = dataclasses.replace(r, input_urls=input_urls, inputs_per_chunk=3)
+
+    opened = []
+    open_cache = r.input_cache.open
+
+    def counting_open(path, **kwargs):
+        if kwargs.get("mode") == "wb":
+            opened.append(path)
+        return open_cache(path, **kwargs)
+
+    monkeypatch.setattr(r.input_cache, "open", counting_open)
+    execute_pipelines(r.to_pipelined_stages(downloader_workers=4))
+    assert sorted(map(str, opened)) == sorted(map(str, fnames))
+
+
+def test_NetCDFtoZarrSequentialRecipe_template_ds(netCDFtoZarr_sequential_recipe):
+    r, ds_expected, _ = netCDFtoZarr_sequential_recipe
+    r.template_ds = ds_expected.isel(time=slice(0, r.nitems_for_chunk(0)))
+
+    # with a template, the target can be prepared before any input is cached
+    r.prepare_target()
+    assert not r.input_cache.exists(next(r.iter_inputs()))
+    execute_recipe(r)
+    assert_target_identical(r, ds_expected)
+
+
+@pytest.mark.parametrize("block_size", [None, 1000])
+def test_NetCDFtoZarrSequentialRecipe_cache_inputs_async(
+    daily_xarray_dataset, netcdf_http_server, tmp_target, tmp_cache, block_size, monkeypatch
+):
+    if block_size:
+        monkeypatch.setattr(recipe, "COPY_BLOCK_SIZE", block_size)
+    url, fnames = netcdf_http_server
+    r = recipe.NetCDFtoZarrSequentialRecipe(
+        input_urls=["/".join([url, fname]) for fname in fnames],
+        sequence_dim="time",
+        nitems_per_input=daily_xarray_dataset.attrs["items_per_file"],
+        target=tmp_target,
+        input_cache=tmp_cache,
+    )
+
+    # the inputs are on http, so they are all cached by a single task
+    pipelines = r.to_pipelines()
+    assert pipelines[0][0].map_args == [list(r.iter_inputs())]
+    execute_pipelines(pipelines)
+    assert_target_identical(r, daily_xarray_dataset)
+
+
+def test_NetCDFtoZarrSequentialRecipe_open_chunk_variables(netCDFtoZarr_sequential_recipe):
+    r, ds_expected, _ = netCDFtoZarr_sequential_recipe
+    for input_key in r.iter_inputs():
+        r.cache_input(input_key)
+
+    ds = r.open_chunk(0, variables=["foo", "time"])
+    assert set(ds.data_vars) == {"foo"}
+    assert ds.foo.identical(ds_expected.foo.isel(time=slice(0, r.nitems_for_chunk(0))))
+
+
+def test_NetCDFtoZarrSequentialRecipe_strict_concat(
+    daily_xarray_dataset, netcdf_local_paths, tmp_cache
+):
+    r = recipe.NetCDFtoZarrSequentialRecipe(
+        input_urls=netcdf_local_paths,
+        sequence_dim="time",
+        inputs_per_chunk=2,
+        nitems_per_input=daily_xarray_dataset.attrs["items_per_file"],
+        input_cache=tmp_cache,
+    )
+    for input_key in r.iter_inputs():
+        r.cache_input(input_key)
+
+    ds = r.open_chunk(0)
+    r.xarray_concat_kwargs = dict(compat="identical", join="exact")
+    assert r.open_chunk(0).identical(ds)
+
+
+def test_NetCDFtoZarrSequentialRecipe_target_encoding(netCDFtoZarr_sequential_recipe):
+    r, ds_expected, target = netCDFtoZarr_sequential_recipe
+    r.target_encoding = {"bar": {"compressor": None}}
+    execute_recipe(r)
+
+    zgroup = zarr.open_group(target.get_mapper())
+    assert zgroup["foo"].compressor == recipe.DEFAULT_COMPRESSOR
+    assert zgroup["bar"].compressor is None
+    assert_target_identical(r, ds_expected)
+
+
+def test_NetCDFtoZarrSequentialRecipe_existing_target(netCDFtoZarr_sequential_recipe, monkeypatch):
+    r, ds_expected, _ = netCDFtoZarr_sequential_recipe
+    execute_recipe(r)
+
+    def fail():
+        raise AssertionError("the target should not be initialized again")
+
+    # preparing an existing target must not overwrite it
+    monkeypatch.setattr(r, "open_template", fail)
+    r.prepare_target()
+    assert_target_identical(r, ds_expected)
+
+
+def test_NetCDFtoZarrSequentialRecipe_reassign_target(netCDFtoZarr_sequential_recipe, tmpdir):
+    r, ds_expected, target = netCDFtoZarr_sequential_recipe
+    other = FSSpecTarget(target.fs, str(tmpdir.join("other")))
+    template_ds = ds_expected[["foo"]].isel(time=slice(0, r.nitems_for_chunk(0)))
+    execute_recipe(dataclasses.replace(r, target=other, template_ds=template_ds))
+    execute_recipe(r)
+    assert set(r._open_chunk_for_store(0).data_vars) == {"foo", "bar"}
+
+    # nothing cached for the previous target may be used for the new one
+    r.target = other
+    assert set(r._open_chunk_for_store(0).data_vars) == {"foo"}
+
+
+def test_NetCDFtoZarrSequentialRecipe_store_empty_chunk(netCDFtoZarr_sequential_recipe):
+    r, ds_expected, _ = netCDFtoZarr_sequential_recipe
+    for input_key in r.iter_inputs():
+        r.cache_input(input_key)
+    r.prepare_target()
+
+    # nothing would be written, which must not pass silently
+    with pytest.raises(ValueError, match="time"):
+        r._write_chunk(0, ds_expected.isel(time=0, drop=True))
+    with pytest.raises(ValueError, match="time"):
+        r._write_chunk(0, xr.Dataset())
+
+
+@pytest.mark.parametrize("inputs_per_chunk", [1, 2])
+def test_NetCDFtoZarrSequentialRecipe_static_data_var(
+    daily_xarray_dataset, tmpdir, tmp_target, tmp_cache, inputs_per_chunk
+):
+    ds = daily_xarray_dataset.copy()
+    ds["mask"] = ("lat", (ds.lat.values > 90).astype("i1"), {"long_name": "Mysterious Mask"})
+    paths = _write_netcdf_inputs(ds, tmpdir)
+
+    r = recipe.NetCDFtoZarrSequentialRecipe(
+        input_urls=paths,
+        sequence_dim="time",
+        inputs_per_chunk=inputs_per_chunk,
+        target=tmp_target,
+        input_cache=tmp_cache,
+    )
+    execute_recipe(r)
+    # like Xarray, the data variable without the sequence dimension gets it
+    assert_target_identical(r, ds.assign(mask=ds.mask.expand_dims(time=ds.time)))
+
+
+def _write_netcdf_inputs(ds, tmpdir):
+    dsets = [ds.isel(time=slice(n, n + 1)) for n in range(ds.dims["time"])]
+    paths = [str(tmpdir.join(f"{n:03d}.nc")) for n in range(len(dsets))]
+    xr.save_mfdataset(dsets, paths)
+    return paths
+
+
+@pytest.mark.parametrize("inputs_per_chunk", [1, 2])
+def test_NetCDFtoZarrSequentialRecipe_time_variables(
+    daily_xarray_dataset, tmpdir, tmp_target, tmp_cache, inputs_per_chunk
+):
+    ds = daily_xarray_dataset.copy()
+    # the CF units of these variables are chosen from their values
+    offsets = np.array([1, 25], dtype="timedelta64[h]")
+    ds["time_bnds"] = (("time", "nv"), ds.time.values[:, None] + offsets)
+    ds["duration"] = ("time", (np.arange(ds.dims["time"]) + 1) * np.timedelta64(90, "m"))
+    ds = ds.set_coords("time_bnds")
+    paths = _write_netcdf_inputs(ds, tmpdir)
+
+    r = recipe.NetCDFtoZarrSequentialRecipe(
+        input_urls=paths,
+        sequence_dim="time",
+        inputs_per_chunk=inputs_per_chunk,
+        target=tmp_target,
+        input_cache=tmp_cache,
+    )
+    execute_recipe(r)
+    ds_target = xr.open_zarr(tmp_target.get_mapper(), consolidated=True).load()
+    xr.testing.assert_equal(ds_target.time_bnds, ds.time_bnds)
+    xr.testing.assert_equal(ds_target.duration, ds.duration)
+
+
+@pytest.mark.parametrize("inputs_per_chunk", [1, 2])
+def test_NetCDFtoZarrSequentialRecipe_scalar_coord(
+    daily_xarray_dataset, tmpdir, tmp_target, tmp_cache, inputs_per_chunk
+):
+    ds = daily_xarray_dataset.assign_coords(height=2.0)
+    paths = _write_netcdf_inputs(ds, tmpdir)
+
+    r = recipe.NetCDFtoZarrSequentialRecipe(
+        input_urls=paths,
+        sequence_dim="time",
+        inputs_per_chunk=inputs_per_chunk,
+        target=tmp_target,
+        input_cache=tmp_cache,
+    )
+    execute_recipe(r)
+    assert_target_identical(r, ds)
+
+
+def test_NetCDFtoZarrSequentialRecipe_unaligned_target(netCDFtoZarr_sequential_recipe):
+    r, ds_expected, _ = netCDFtoZarr_sequential_recipe
+    execute_recipe(dataclasses.replace(r, inputs_per_chunk=4))
+
+    # the Zarr chunks of the existing target span several chunks of this recipe
+    r = dataclasses.replace(r, store_workers=4)
+    assert not r._target_chunks_aligned()
+    execute_pipelines(r.to_pipelines())
+    assert_target_identical(r, ds_expected)
+
+
+def test_NetCDFtoZarrSequentialRecipe_pipelined_stages_unaligned_target(
+    netCDFtoZarr_sequential_recipe,
+):
+    r, ds_expected, _ = netCDFtoZarr_sequential_recipe
+    execute_recipe(dataclasses.replace(r, inputs_per_chunk=4))
+
+    execute_pipelines(r.to_pipelined_stages(writer_workers=4))
+    assert_target_identical(r, ds_expected)
+
+
+class RangeFileSystem:
+    # minimal async filesystem honouring range requests, unless told otherwise
+    def __init__(self, data, ranges=True, fail_at=None):
+        self.data = data
+        self.ranges = ranges
+        self.fail_at = fail_at
+        self.requests = []
+        self.active = self.max_active = 0
+
+    async def _info(self, path):
+        return {"size": len(self.data)}
+
+    async def _cat_file(self, path, start=None, end=None):
+        self.requests.append((start, end))
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        await asyncio.sleep(0.01)
+        self.active -= 1
+        if start is not None and start == self.fail_at:
+            raise OSError("connection reset")
+        if not self.ranges:
+            return self.data
+        return self.data[start:end]
+
+
+@pytest.mark.parametrize("ranges", [True, False])
+def test_iter_blocks(monkeypatch, ranges):
+    monkeypatch.setattr(recipe, "COPY_BLOCK_SIZE", 10)
+    fs = RangeFileSystem(bytes(range(95)), ranges=ranges)
+
+    async def read():
+        return [block async for block in recipe._iter_blocks(fs, "data")]
+
+    blocks = asyncio.run(read())
+    assert b"".join(blocks) == fs.data
+    if ranges:
+        assert len(blocks) == 10
+        assert fs.requests[-1] == (90, 95)
+    else:
+        # the whole file was returned by the first request
+        assert len(blocks) == 1
+
+
+def test_NetCDFtoZarrSequentialRecipe_store_failed_chunk(netCDFtoZarr_sequential_recipe):
+    r, ds_expected, target = netCDFtoZarr_sequential_recipe
+    for input_key in r.iter_inputs():
+        r.cache_input(input_key)
+    r.prepare_target()
+
+    # "baz" is not in the target, so writing it fails after "foo" was buffered
+    ds_chunk = r._open_chunk_for_store(1)
+    with pytest.raises(zarr.errors.ArrayNotFoundError):
+        r._write_chunk(1, ds_chunk.assign(baz=ds_chunk.foo))
+    # the next write must not flush the partial chunk
+    r.store_chunk(0)
+
+    ds_target = xr.open_zarr(target.get_mapper()).load()
+    assert ds_target.foo.isel(time=r.region_for_chunk(1)["time"]).isnull().all()
+    assert ds_target.foo.isel(time=r.region_for_chunk(0)["time"]).notnull().all()
+
+
+def test_NetCDFtoZarrSequentialRecipe_cache_inputs_async_concurrency(tmp_cache):
+    fs = RangeFileSystem(b"data")
+    fnames = [f"{n}.nc" for n in range(8)]
+    r = recipe.NetCDFtoZarrSequentialRecipe(
+        input_urls=fnames, sequence_dim="time", input_cache=tmp_cache
+    )
+
+    # downloads are concurrent, independently of max_workers
+    asyncio.run(r._cache_inputs_async(fs, [(fname, fname) for fname in fnames]))
+    assert fs.max_active == len(fnames)
+    for fname in fnames:
+        with r.input_cache.open(fname, mode="rb") as f:
+            assert f.read() == fs.data
+
+
+def test_NetCDFtoZarrSequentialRecipe_cache_inputs_async_failure(tmp_cache, monkeypatch):
+    monkeypatch.setattr(recipe, "COPY_BLOCK_SIZE", 10)
+    fs = RangeFileSystem(bytes(range(95)), fail_at=50)
+    r = recipe.NetCDFtoZarrSequentialRecipe(
+        input_urls=["a.nc"], sequence_dim="time", input_cache=tmp_cache
+    )
+
+    # the blocks before the failure must not be left in the cache
+    with pytest.raises(OSError, match="connection reset"):
+        asyncio.run(r._cache_inputs_async(fs, [("a.nc", "a.nc")]))
+    assert not r.input_cache.exists("a.nc")
@@ -1,4 +1,10 @@
+import io
+
+import fsspec
+import numpy as np
 import pytest
+import xarray as xr
+import zarr
 
 import pangeo_forge.utils
 
@@ -15,3 +21,91 @@ import pangeo_forge.utils
 def test_chunked_iterable(iterable, size, expected):
     actual = list(pangeo_forge.utils.chunked_iterable(iterable, size))
     assert actual == expected
+
+
+@pytest.mark.parametrize("local", [True, False])
+def test_copy_fileobj(tmpdir, local):
+    data = bytes(range(256)) * 1000
+    src_path = str(tmpdir.join("src"))
+    dst_path = str(tmpdir.join("dst"))
+    with open(src_path, mode="wb") as f:
+        f.write(data)
+
+    if local:
+        with fsspec.open(src_path, mode="rb") as source:
+            with fsspec.open(dst_path, mode="wb") as target:
+                pangeo_forge.utils.copy_fileobj(source, target)
+        with open(dst_path, mode="rb") as f:
+            assert f.read() == data
+    else:
+        target = io.BytesIO()
+        pangeo_forge.utils.copy_fileobj(io.BytesIO(data), target, length=1000)
+        assert target.getvalue() == data
+
+
+def test_concat_numpy(daily_xarray_dataset):
+    ds = daily_xarray_dataset
+    dsets = [ds.isel(time=slice(0, 3)), ds.isel(time=slice(3, 4)), ds.isel(time=slice(4, None))]
+    actual = pangeo_forge.utils.concat_numpy(dsets, "time")
+    assert actual.identical(ds)
+    assert set(actual.coords) == set(ds.coords)
+
+    # like xr.concat, data variables without the dimension are repeated along it
+    ds_static = ds.assign(mask=ds.foo.isel(time=0, drop=True))
+    dsets = [ds_static.isel(time=slice(0, 3)), ds_static.isel(time=slice(3, None))]
+    expected = xr.concat(dsets, "time", compat="override", coords="minimal")
+    assert pangeo_forge.utils.concat_numpy(dsets, "time").identical(expected)
+
+    assert pangeo_forge.utils.concat_numpy([ds, ds.drop_vars("foo")], "time") is None
+    assert pangeo_forge.utils.concat_numpy([ds, ds.isel(lat=slice(1, None))], "time") is None
+    # "time" is only a scalar coordinate, so it must be added by xr.concat
+    assert pangeo_forge.utils.concat_numpy([ds.isel(time=0), ds.isel(time=1)], "time") is None
+
+
+def test_run_pipelined():
+    results = []
+    stages = [(lambda x: x + 1, 3), (lambda x: 2 * x, 2), (results.append, 1)]
+    pangeo_forge.utils.run_pipelined(range(10), stages, queue_size=1)
+    assert sorted(results) == [2 * (x + 1) for x in range(10)]
+
+    def fail(x):
+        if x == 5:
+            raise ValueError("boom")
+        return x
+
+    with pytest.raises(ValueError, match="boom"):
+        pangeo_forge.utils.run_pipelined(range(10), [(fail, 2), (lambda x: x, 2)])
+
+
+def test_zarr_array_encoding(daily_xarray_dataset, tmpdir):
+    store = str(tmpdir.join("test.zarr"))
+    daily_xarray_dataset.to_zarr(store)
+    zgroup = zarr.open_group(store)
+    ds = xr.open_zarr(store)
+    for name in ds.variables:
+        expected = {
+            k: v
+            for k, v in ds[name].encoding.items()
+            if k not in ("chunks", "compressor", "filters")
+        }
+        actual = pangeo_forge.utils.zarr_array_encoding(name, zgroup[name])
+        np.testing.assert_equal(actual, expected)
+
+
+@pytest.mark.parametrize("clear_encoding", [False, True])
+def test_fix_scalar_attr_encoding(clear_encoding):
+    ds = xr.Dataset(
+        {"foo": ("x", [1, 2], {"scale": np.array([2.0])})}, attrs={"title": np.array(["a"])}
+    )
+    ds.foo.encoding = {"_FillValue": np.array([-1]), "dtype": "i2"}
+    fixed = pangeo_forge.utils.fix_scalar_attr_encoding(ds, clear_encoding=clear_encoding)
+
+    assert fixed.attrs["title"] == "a"
+    assert fixed.foo.attrs["scale"] == 2.0
+    if clear_encoding:
+        assert fixed.foo.encoding == {}
+    else:
+        assert fixed.foo.encoding == {"_FillValue": -1, "dtype": "i2"}
+    # the original dataset is left untouched
+    assert isinstance(ds.foo.attrs["scale"], np.ndarray)
+    assert "dtype" in ds.foo.encoding